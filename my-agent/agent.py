@@ -1,15 +1,19 @@
 ﻿from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import functools
 import os
 import re
 from pathlib import Path
-from typing import Any
-
-from openai import OpenAI
+from typing import TYPE_CHECKING, Any, Callable
 
 from memory import MemoryStore
 from tools import execute_tool, get_tool_specs, web_lookup
+
+if TYPE_CHECKING:
+    # openai pulls in httpx/pydantic; only import it once a client is actually built.
+    from openai import OpenAI
 
 
 SYSTEM_PROMPT = """You are a pragmatic coding agent running on Windows.
@@ -19,6 +23,10 @@ Understand both Dutch and English user input, including casual greetings/slang.
 If a user term is unclear, use web_lookup to infer meaning before answering.
 """
 
+# Shared, never-mutated prefix messages: every turn starts with the same dict
+# objects, so the serialized prompt prefix is identical from turn to turn.
+_BASE_SYSTEM: tuple[dict[str, str], ...] = ({"role": "system", "content": SYSTEM_PROMPT},)
+
 GREETING_WORDS = {
     "hi",
     "hello",
@@ -34,23 +42,62 @@ GREETING_WORDS = {
     "goedenavond",
 }
 
+# Greeting-only inputs are recognised with a single fullmatch over the lowered
+# text: greeting words separated by anything that is not a letter or digit.
+_GREETING_ALTERNATION = "|".join(sorted(GREETING_WORDS, key=len, reverse=True))
+_GREETING_ONLY_RE = re.compile(rf"[^a-z0-9]*(?:(?:{_GREETING_ALTERNATION})(?![a-z0-9])[^a-z0-9]*)+")
+_SHORT_GREETING_RE = re.compile(rf"[^a-z0-9]*(?:(?:{_GREETING_ALTERNATION})(?![a-z0-9])[^a-z0-9]*){{1,3}}")
+_DUTCH_GREETING_RE = re.compile(r"(?<![a-z0-9])(?:hoi|hallo|goedemorgen|goedemiddag|goedenavond)(?![a-z0-9])")
+_LOOKUP_CLEAN_RE = re.compile(r"[^a-zA-Z0-9\s\-_/]")
+# Byte-level equivalent of _LOOKUP_CLEAN_RE for pure-ASCII input (the common case).
+_LOOKUP_CLEAN_TABLE = bytes(
+    c if c < 128 and (chr(c).isalnum() or chr(c).isspace() or chr(c) in "-_/") else 0x20 for c in range(256)
+)
+# Code fences, paths and coding verbs mark a task for the agent, not a term to look up.
+_SKIP_LOOKUP_RE = re.compile(
+    r"```|[/\\][A-Za-z_.-]+|\b(write|fix|refactor|add|delete|run|install|create|update|rename|move)\b",
+    re.IGNORECASE,
+)
+_LOOKUP_PATTERNS = tuple(
+    re.compile(pattern)
+    for pattern in (
+        r"^wat betekent\s+(.+?)\??$",
+        r"^what does\s+(.+?)\s+mean\??$",
+        r"^what is\s+(.+?)\??$",
+        r"^meaning of\s+(.+?)\??$",
+    )
+)
 
-def maybe_handle_smalltalk(user_input: str) -> str | None:
-    cleaned = re.sub(r"[^a-zA-Z0-9\\s]", " ", user_input.lower()).strip()
-    if not cleaned:
-        return None
+# The web prefetch runs next to prompt assembly; a lookup that is not back in
+# time is skipped for this turn instead of delaying the model call.
+WEB_PREFETCH_TIMEOUT_SECONDS = 0.3
+_WEB_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="web-prefetch")
 
-    words = [w for w in cleaned.split() if w]
-    if not words:
+# Every tool round resends the whole conversation, so keep the loop short and
+# stop feeding the model identical calls it has already seen answered.
+MAX_TOOL_ROUNDS = 6
+TOOL_EXCHANGES_KEPT = 3
+TOOL_CONTEXT_CHAR_BUDGET = 24000
+TOOL_SUMMARY_CHARS = 200
+_DUPLICATE_CALL_OUTPUT = '{"ok": false, "error": "Duplicate tool call skipped; use the earlier result."}'
+_REPEATED_CALLS_ANSWER = "Stopped because the model kept repeating the same tool call."
+# Tools that can change files or other state; earlier results may be stale after them.
+_STATE_CHANGING_TOOLS = frozenset({"write_file", "run_shell"})
+
+# Responses API follow-ups chain on previous_response_id. Not every server keeps
+# the tool schema across that link, so resending stays the default.
+RESEND_TOOLS_ON_FOLLOWUP = os.getenv("AGENT_RESPONSES_RESEND_TOOLS", "1") != "0"
+
+
+def maybe_handle_smalltalk(user_input: str) -> str | None:
+    lowered = user_input.lower()
+    if _SHORT_GREETING_RE.fullmatch(lowered) is None:
         return None
 
     # Fast path for short greetings so the assistant feels responsive.
-    if len(words) <= 3 and all(w in GREETING_WORDS for w in words):
-        if any(w in {"hoi", "hallo", "goedemorgen", "goedemiddag", "goedenavond"} for w in words):
-            return "Hoi! Ik ben er. Zeg maar wat je wilt doen, dan help ik je direct."
-        return "Hey! I'm here. Tell me what you want to build or fix."
-
-    return None
+    if _DUTCH_GREETING_RE.search(lowered) is not None:
+        return "Hoi! Ik ben er. Zeg maar wat je wilt doen, dan help ik je direct."
+    return "Hey! I'm here. Tell me what you want to build or fix."
 
 
 def _extract_lookup_query(user_input: str) -> str | None:
@@ -59,24 +106,24 @@ def _extract_lookup_query(user_input: str) -> str | None:
         return None
 
     lowered = text.lower()
-    patterns = [
-        r"^wat betekent\s+(.+?)\??$",
-        r"^what does\s+(.+?)\s+mean\??$",
-        r"^what is\s+(.+?)\??$",
-        r"^meaning of\s+(.+?)\??$",
-    ]
-    for pattern in patterns:
-        m = re.match(pattern, lowered)
+    for pattern in _LOOKUP_PATTERNS:
+        m = pattern.match(lowered)
         if m:
             return m.group(1).strip(" .,!?:;\"'")
 
-    cleaned = re.sub(r"[^a-zA-Z0-9\s\-_/]", " ", text).strip()
+    if _GREETING_ONLY_RE.fullmatch(lowered) is not None or _SKIP_LOOKUP_RE.search(text) is not None:
+        return None
+
+    if text.isascii():
+        cleaned = text.encode("ascii").translate(_LOOKUP_CLEAN_TABLE).decode("ascii").strip()
+    else:
+        cleaned = _LOOKUP_CLEAN_RE.sub(" ", text).strip()
     words = [w for w in cleaned.split() if w]
     if not words:
         return None
 
     # For short/medium messages, prefetch web context immediately.
-    if 1 <= len(words) <= 12 and not all(w.lower() in GREETING_WORDS for w in words):
+    if len(words) <= 12:
         return " ".join(words)
     return None
 
@@ -101,6 +148,14 @@ def _maybe_prefetch_web_context(user_input: str) -> str | None:
     return f"Web context for possibly unclear term:\n- query: {query}\n- title: {title}\n- source: {source}\n- url: {url}\n- summary: {summary}"
 
 
+def _await_web_context(future: concurrent.futures.Future[str | None]) -> str | None:
+    try:
+        return future.result(timeout=WEB_PREFETCH_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        return None
+
+
+@functools.cache
 def _chat_tools_from_specs() -> list[dict[str, Any]]:
     tools = []
     for spec in get_tool_specs():
@@ -119,49 +174,233 @@ def _chat_tools_from_specs() -> list[dict[str, Any]]:
     return tools
 
 
+@functools.lru_cache(maxsize=8)
+def _workspace_message(workspace: Path) -> dict[str, str]:
+    return {"role": "system", "content": f"Workspace: {workspace}"}
+
+
+def _history_messages(memory: MemoryStore, user_input: str) -> list[dict[str, str]]:
+    # History goes out as plain role messages after the static system prompt, so
+    # each turn's prompt extends the previous one and server-side prefix caches hit.
+    recent = memory.recent_messages(9)
+    if recent and recent[-1].get("role") == "user" and recent[-1].get("content") == user_input:
+        recent = recent[:-1]
+    return [{"role": item["role"], "content": item["content"]} for item in recent[-8:]]
+
+
+def _execute_tool_once(name: str, arguments: str, workspace: Path, seen_calls: set[tuple[str, str]]) -> str:
+    key = (name, arguments)
+    if key in seen_calls:
+        return _DUPLICATE_CALL_OUTPUT
+    if name in _STATE_CHANGING_TOOLS:
+        # e.g. run tests -> edit -> run tests again must not count as a repeat.
+        seen_calls.clear()
+    seen_calls.add(key)
+    return execute_tool(name, arguments, workspace)
+
+
+def _message_chars(message: dict[str, Any]) -> int:
+    size = len(message.get("content") or "")
+    for call in message.get("tool_calls") or []:
+        size += len(call["function"]["arguments"])
+    return size
+
+
+def _summarize_exchange(exchange: list[dict[str, Any]]) -> list[str]:
+    names = {call["id"]: call["function"]["name"] for call in exchange[0].get("tool_calls") or []}
+    return [
+        f"[tool {names.get(message['tool_call_id'], 'unknown')} returned: {message['content'][:TOOL_SUMMARY_CHARS]}]"
+        for message in exchange[1:]
+    ]
+
+
+def _trim_tool_exchanges(messages: list[dict[str, Any]], start: int) -> list[tuple[str, str]]:
+    # FIFO paging of whole assistant/tool exchanges (a tool message must not
+    # outlive the call it answers): once more than TOOL_EXCHANGES_KEPT exchanges
+    # exist or they outgrow the char budget, the oldest one is folded into a
+    # single summary message at `start`. The newest exchange is always kept.
+    # Returns the (name, arguments) of the folded calls, whose full results
+    # are no longer in context.
+    folded: list[tuple[str, str]] = []
+    has_summary = start < len(messages) and messages[start]["role"] == "system"
+    first = start + 1 if has_summary else start
+    while True:
+        starts = [i for i in range(first, len(messages)) if messages[i]["role"] == "assistant"]
+        if len(starts) <= 1:
+            return folded
+        if len(starts) <= TOOL_EXCHANGES_KEPT and sum(_message_chars(m) for m in messages[first:]) <= TOOL_CONTEXT_CHAR_BUDGET:
+            return folded
+        folded.extend(
+            (call["function"]["name"], call["function"]["arguments"])
+            for call in messages[first].get("tool_calls") or []
+        )
+        lines = "\n".join(_summarize_exchange(messages[first : starts[1]]))
+        del messages[first : starts[1]]
+        if has_summary:
+            messages[start] = {"role": "system", "content": f"{messages[start]['content']}\n{lines}"}
+        else:
+            messages.insert(start, {"role": "system", "content": f"Earlier tool results this turn:\n{lines}"})
+            has_summary = True
+            first = start + 1
+
+
+def _is_local_base(url: str | None) -> bool:
+    if not url:
+        return False
+    url_lc = url.lower()
+    return "localhost" in url_lc or "127.0.0.1" in url_lc
+
+
 def _choose_api_mode(mode: str, base_url: str | None) -> str:
     if mode in {"responses", "chat"}:
         return mode
-    if not base_url:
-        return "responses"
-    lower = base_url.lower()
-    if "localhost" in lower or "127.0.0.1" in lower:
-        return "chat"
-    return "responses"
+    return "chat" if _is_local_base(base_url) else "responses"
 
 
-def run_turn_responses(client: OpenAI, model: str, user_input: str, workspace: Path, memory: MemoryStore) -> str:
+_TERMINAL_RESPONSE_EVENTS = frozenset({"response.completed", "response.incomplete", "response.failed"})
+
+
+def _create_response(client: OpenAI, on_delta: Callable[[str], None] | None, **kwargs: Any) -> Any:
+    if on_delta is None:
+        return client.responses.create(**kwargs)
+
+    response = None
+    for event in client.responses.create(stream=True, **kwargs):
+        if event.type == "response.output_text.delta":
+            on_delta(event.delta)
+        elif event.type in _TERMINAL_RESPONSE_EVENTS:
+            # Incomplete/failed responses are returned as-is, like without streaming.
+            response = event.response
+    if response is None:
+        raise RuntimeError("Response stream ended without a final response.")
+    return response
+
+
+def _create_chat_completion(
+    client: OpenAI,
+    model: str,
+    messages: list[dict[str, Any]],
+    tools: list[dict[str, Any]],
+    on_delta: Callable[[str], None] | None,
+) -> tuple[str, list[dict[str, Any]]]:
+    if on_delta is None:
+        completion = client.chat.completions.create(model=model, messages=messages, tools=tools, tool_choice="auto")
+        message = completion.choices[0].message
+        tool_calls = [
+            {
+                "id": call.id,
+                "type": "function",
+                "function": {"name": call.function.name, "arguments": call.function.arguments},
+            }
+            for call in message.tool_calls or []
+        ]
+        return message.content or "", tool_calls
+
+    # Streamed tool calls arrive as fragments keyed by index; stitch them back together.
+    content_parts: list[str] = []
+    calls_by_index: dict[int, dict[str, Any]] = {}
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        tools=tools,
+        tool_choice="auto",
+        stream=True,
+    )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content_parts.append(delta.content)
+            on_delta(delta.content)
+        for fragment in delta.tool_calls or []:
+            call = calls_by_index.setdefault(
+                fragment.index,
+                {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if fragment.id:
+                call["id"] = fragment.id
+            if fragment.function is not None:
+                call["function"]["name"] += fragment.function.name or ""
+                call["function"]["arguments"] += fragment.function.arguments or ""
+    return "".join(content_parts), [calls_by_index[i] for i in sorted(calls_by_index)]
+
+
+def run_turn_responses(
+    client: OpenAI,
+    model: str,
+    user_input: str,
+    workspace: Path,
+    memory: MemoryStore,
+    on_delta: Callable[[str], None] | None = None,
+) -> str:
     smalltalk = maybe_handle_smalltalk(user_input)
     if smalltalk is not None:
         return smalltalk
 
-    recent = memory.recent(8)
-    history_lines = [f"{item['role']}: {item['content']}" for item in recent]
-    history_block = "\n".join(history_lines)
-    web_context = _maybe_prefetch_web_context(user_input)
-    system_input: list[dict[str, str]] = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": f"Workspace: {workspace}"},
-        {"role": "system", "content": f"Recent memory:\n{history_block}"},
-    ]
+    web_future = _WEB_POOL.submit(_maybe_prefetch_web_context, user_input)
+
+    response = None
+    previous_response_id = memory.last_response_id
+    memory.last_response_id = None
+    # Without a chain to continue, build the full prompt while the lookup runs.
+    system_input: list[dict[str, str]] = []
+    if not previous_response_id:
+        system_input = [*_BASE_SYSTEM, _workspace_message(workspace)]
+        system_input.extend(_history_messages(memory, user_input))
+
+    turn_input: list[dict[str, str]] = []
+    web_context = _await_web_context(web_future)
     if web_context:
-        system_input.append({"role": "system", "content": web_context})
-    system_input.append({"role": "user", "content": user_input})
+        turn_input.append({"role": "system", "content": web_context})
+    turn_input.append({"role": "user", "content": user_input})
 
-    response = client.responses.create(
-        model=model,
-        input=system_input,
-        tools=get_tool_specs(),
-    )
+    if previous_response_id:
+        # The server still holds the earlier turns for this response chain, so
+        # only the new input is sent.
+        from openai import BadRequestError, NotFoundError
 
-    while True:
+        try:
+            response = _create_response(
+                client,
+                on_delta,
+                model=model,
+                previous_response_id=previous_response_id,
+                input=turn_input,
+                tools=get_tool_specs(),
+            )
+        except (BadRequestError, NotFoundError):
+            response = None
+
+    if response is None:
+        if not system_input:
+            system_input = [*_BASE_SYSTEM, _workspace_message(workspace)]
+            system_input.extend(_history_messages(memory, user_input))
+        system_input.extend(turn_input)
+        response = _create_response(
+            client,
+            on_delta,
+            model=model,
+            input=system_input,
+            tools=get_tool_specs(),
+        )
+
+    followup_tools = {"tools": get_tool_specs()} if RESEND_TOOLS_ON_FOLLOWUP else {}
+    seen_calls: set[tuple[str, str]] = set()
+    for round_index in range(MAX_TOOL_ROUNDS):
         function_calls = [item for item in response.output if item.type == "function_call"]
         if not function_calls:
+            memory.last_response_id = response.id
             return response.output_text.strip()
+        if all((call.name, call.arguments) in seen_calls for call in function_calls):
+            return response.output_text.strip() or _REPEATED_CALLS_ANSWER
+        # Like run_turn_chat: at most MAX_TOOL_ROUNDS model calls per turn.
+        if round_index == MAX_TOOL_ROUNDS - 1:
+            break
 
         tool_outputs = []
         for call in function_calls:
-            output = execute_tool(call.name, call.arguments, workspace)
+            output = _execute_tool_once(call.name, call.arguments, workspace, seen_calls)
             tool_outputs.append(
                 {
                     "type": "function_call_output",
@@ -170,58 +409,66 @@ def run_turn_responses(client: OpenAI, model: str, user_input: str, workspace: P
                 }
             )
 
-        response = client.responses.create(
+        response = _create_response(
+            client,
+            on_delta,
             model=model,
             previous_response_id=response.id,
             input=tool_outputs,
-            tools=get_tool_specs(),
+            **followup_tools,
         )
 
+    return "Stopped after too many tool iterations."
 
-def run_turn_chat(client: OpenAI, model: str, user_input: str, workspace: Path, memory: MemoryStore) -> str:
+
+def run_turn_chat(
+    client: OpenAI,
+    model: str,
+    user_input: str,
+    workspace: Path,
+    memory: MemoryStore,
+    on_delta: Callable[[str], None] | None = None,
+) -> str:
+    # The server-side Responses chain won't contain this turn; a later
+    # Responses turn must rebuild the full history instead of chaining.
+    memory.last_response_id = None
     smalltalk = maybe_handle_smalltalk(user_input)
     if smalltalk is not None:
         return smalltalk
 
-    recent = memory.recent(8)
-    history_lines = [f"{item['role']}: {item['content']}" for item in recent]
-    history_block = "\n".join(history_lines)
-    web_context = _maybe_prefetch_web_context(user_input)
+    web_future = _WEB_POOL.submit(_maybe_prefetch_web_context, user_input)
 
-    messages: list[dict[str, Any]] = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": f"Workspace: {workspace}"},
-        {"role": "system", "content": f"Recent memory:\n{history_block}"},
-    ]
+    messages: list[dict[str, Any]] = [*_BASE_SYSTEM, _workspace_message(workspace)]
+    messages.extend(_history_messages(memory, user_input))
+    web_context = _await_web_context(web_future)
     if web_context:
         messages.append({"role": "system", "content": web_context})
     messages.append({"role": "user", "content": user_input})
     tools = _chat_tools_from_specs()
+    exchanges_start = len(messages)
+    seen_calls: set[tuple[str, str]] = set()
 
-    for _ in range(12):
-        completion = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=tools,
-            tool_choice="auto",
-        )
-        message = completion.choices[0].message
-        tool_calls = message.tool_calls or []
+    for _ in range(MAX_TOOL_ROUNDS):
+        content, tool_calls = _create_chat_completion(client, model, messages, tools, on_delta)
 
         if not tool_calls:
-            return (message.content or "").strip()
+            return content.strip()
+        if all((call["function"]["name"], call["function"]["arguments"]) in seen_calls for call in tool_calls):
+            return content.strip() or _REPEATED_CALLS_ANSWER
 
-        messages.append({"role": "assistant", "content": message.content or "", "tool_calls": tool_calls})
+        messages.append({"role": "assistant", "content": content, "tool_calls": tool_calls})
 
         for call in tool_calls:
-            output = execute_tool(call.function.name, call.function.arguments, workspace)
+            output = _execute_tool_once(call["function"]["name"], call["function"]["arguments"], workspace, seen_calls)
             messages.append(
                 {
                     "role": "tool",
-                    "tool_call_id": call.id,
+                    "tool_call_id": call["id"],
                     "content": output,
                 }
             )
+        # A folded result may be fetched again, so it no longer counts as a repeat.
+        seen_calls.difference_update(_trim_tool_exchanges(messages, exchanges_start))
 
     return "Stopped after too many tool iterations."
 
@@ -241,7 +488,7 @@ def main() -> None:
 
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
-        if args.base_url and ("localhost" in args.base_url.lower() or "127.0.0.1" in args.base_url.lower()):
+        if _is_local_base(args.base_url):
             api_key = "lm-studio"
         else:
             raise SystemExit("OPENAI_API_KEY not set. Set it first and retry.")
@@ -250,6 +497,8 @@ def main() -> None:
     workspace.mkdir(parents=True, exist_ok=True)
 
     memory = MemoryStore(workspace / ".agent" / "memory.json")
+    from openai import OpenAI
+
     client = OpenAI(api_key=api_key, base_url=args.base_url)
     api_mode = _choose_api_mode(args.api_mode, args.base_url)
 
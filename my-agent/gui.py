@@ -1,18 +1,28 @@
 ﻿from __future__ import annotations
 
 import os
+import queue
 import subprocess
 import threading
 import time
 import tkinter as tk
 from pathlib import Path
 from tkinter import messagebox, scrolledtext
+from typing import TYPE_CHECKING
 
-from openai import OpenAI
-
-from agent import _choose_api_mode, run_turn_chat, run_turn_responses
+from agent import _choose_api_mode, _is_local_base, maybe_handle_smalltalk, run_turn_chat, run_turn_responses
 from memory import MemoryStore
 
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+
+ROLE_LABELS = {
+    "you": ("YOU", "role_user"),
+    "agent": ("AGENT", "role_agent"),
+    "system": ("SYSTEM", "role_system"),
+}
+
 
 class AgentGui:
     def __init__(self, root: tk.Tk) -> None:
@@ -41,21 +51,60 @@ class AgentGui:
         self.font_ui_bold = ("Segoe UI Semibold", 9 if self.compact_mode else 10)
         self.font_chat = ("Consolas", 10 if self.compact_mode else 11)
 
+        self._entry_opts = {
+            "bg": self.colors["panel_alt"],
+            "fg": self.colors["text"],
+            "insertbackground": self.colors["text"],
+            "relief": "flat",
+            "highlightthickness": 1,
+            "highlightbackground": "#2a3143",
+            "highlightcolor": self.colors["accent"],
+            "font": self.font_ui,
+        }
+        button_common = {
+            "activeforeground": "#ffffff",
+            "relief": "flat",
+            "bd": 0,
+            "padx": 8 if self.compact_mode else 10,
+            "pady": 4 if self.compact_mode else 6,
+            "font": self.font_ui_bold,
+            "cursor": "hand2",
+        }
+        self._btn_opts_primary = {
+            "bg": self.colors["accent"],
+            "fg": "#ffffff",
+            "activebackground": self.colors["accent_active"],
+            **button_common,
+        }
+        self._btn_opts_secondary = {
+            "bg": self.colors["panel_alt"],
+            "fg": self.colors["text"],
+            "activebackground": "#2b3245",
+            **button_common,
+        }
+
         self.workspace_var = tk.StringVar(value=str(Path.cwd()))
         self.base_url_var = tk.StringVar(value=os.getenv("OPENAI_BASE_URL", "http://127.0.0.1:1234/v1"))
         self.model_var = tk.StringVar(value="google/gemma-3-4b")
         self.api_mode_var = tk.StringVar(value="auto")
+        self.api_mode_var.trace_add("write", self._on_api_mode_changed)
 
         self.client: OpenAI | None = None
+        self._base_url: str | None = None
+        self._api_mode = "responses"
         self.workspace = Path(self.workspace_var.get()).resolve()
         self.memory = MemoryStore(self.workspace / ".agent" / "memory.json")
         self.busy = False
         self.typing_visible = False
+        self._deltas: queue.SimpleQueue[str] = queue.SimpleQueue()
+        self._stream_parts: list[str] = []
+        self._streaming = False
+        self._pending_delta: list[str] = []
+        self._flush_scheduled = False
 
         self._build_ui()
 
     def _fit_window_to_screen(self) -> None:
-        self.root.update_idletasks()
         screen_w = self.root.winfo_screenwidth()
         screen_h = self.root.winfo_screenheight()
 
@@ -66,33 +115,10 @@ class AgentGui:
         self.root.geometry(f"{target_w}x{target_h}+{pos_x}+{pos_y}")
 
     def _style_entry(self, entry: tk.Entry) -> None:
-        entry.configure(
-            bg=self.colors["panel_alt"],
-            fg=self.colors["text"],
-            insertbackground=self.colors["text"],
-            relief="flat",
-            highlightthickness=1,
-            highlightbackground="#2a3143",
-            highlightcolor=self.colors["accent"],
-            font=self.font_ui,
-        )
+        entry.configure(**self._entry_opts)
 
     def _style_button(self, button: tk.Button, primary: bool = False) -> None:
-        bg = self.colors["accent"] if primary else self.colors["panel_alt"]
-        fg = "#ffffff" if primary else self.colors["text"]
-        active_bg = self.colors["accent_active"] if primary else "#2b3245"
-        button.configure(
-            bg=bg,
-            fg=fg,
-            activebackground=active_bg,
-            activeforeground="#ffffff",
-            relief="flat",
-            bd=0,
-            padx=8 if self.compact_mode else 10,
-            pady=4 if self.compact_mode else 6,
-            font=self.font_ui_bold,
-            cursor="hand2",
-        )
+        button.configure(**(self._btn_opts_primary if primary else self._btn_opts_secondary))
 
     def _build_ui(self) -> None:
         self.root.configure(bg=self.colors["bg"])
@@ -262,12 +288,7 @@ class AgentGui:
         self._append("system", "Klik op Connect, daarna kun je chatten. Ctrl+Enter = versturen.")
 
     def _append(self, role: str, text: str) -> None:
-        role_map = {
-            "you": ("YOU", "role_user"),
-            "agent": ("AGENT", "role_agent"),
-            "system": ("SYSTEM", "role_system"),
-        }
-        label, tag = role_map.get(role, (role.upper(), "role_system"))
+        label, tag = ROLE_LABELS.get(role, (role.upper(), "role_system"))
 
         self.chat.configure(state="normal")
         self.chat.insert("end", f"{label}> ", tag)
@@ -275,6 +296,50 @@ class AgentGui:
         self.chat.see("end")
         self.chat.configure(state="disabled")
 
+    def _append_start(self, role: str) -> None:
+        self._clear_typing_indicator()
+        label, tag = ROLE_LABELS.get(role, (role.upper(), "role_system"))
+        self.chat.configure(state="normal")
+        self.chat.insert("end", f"{label}> ", tag)
+        self.chat.see("end")
+        self.chat.configure(state="disabled")
+        self._streaming = True
+
+    def _append_delta(self, text: str) -> None:
+        # Buffer deltas and flush at ~30 Hz so the text widget reflows once per batch.
+        self._pending_delta.append(text)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.root.after(33, self._flush_chat)
+
+    def _flush_chat(self) -> None:
+        self._flush_scheduled = False
+        if not self._pending_delta:
+            return
+        text = "".join(self._pending_delta)
+        self._pending_delta.clear()
+        self._stream_parts.append(text)
+        self.chat.configure(state="normal")
+        self.chat.insert("end", text, "msg")
+        self.chat.see("end")
+        self.chat.configure(state="disabled")
+
+    def _drain_deltas(self) -> None:
+        # Worker threads only put text on the queue; widgets are touched here, on the Tk thread.
+        while True:
+            try:
+                text = self._deltas.get_nowait()
+            except queue.Empty:
+                return
+            if not self._streaming:
+                self._append_start("agent")
+            self._append_delta(text)
+
+    def _poll_deltas(self) -> None:
+        self._drain_deltas()
+        if self.busy:
+            self.root.after(33, self._poll_deltas)
+
     def _show_typing_indicator(self) -> None:
         if self.typing_visible:
             return
@@ -315,7 +380,7 @@ class AgentGui:
 
         base_url = self.base_url_var.get().strip() or None
         api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key and base_url and ("localhost" in base_url.lower() or "127.0.0.1" in base_url.lower()):
+        if not api_key and _is_local_base(base_url):
             api_key = "lm-studio"
 
         if not api_key:
@@ -323,14 +388,25 @@ class AgentGui:
             return
 
         self.workspace = workspace
+        self.memory.close()
         self.memory = MemoryStore(self.workspace / ".agent" / "memory.json")
+
+        from openai import OpenAI
+
         self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self._base_url = base_url
+        self._api_mode = _choose_api_mode(self.api_mode_var.get(), base_url)
 
-        mode = _choose_api_mode(self.api_mode_var.get(), base_url)
-        self.status_var.set(f"Connected ({mode})")
+        self.status_var.set(f"Connected ({self._api_mode})")
         self.status_label.configure(fg=self.colors["ok"])
         self._append("system", f"Connected. Workspace={self.workspace}")
 
+    def _on_api_mode_changed(self, *_args: object) -> None:
+        # Keep the cached mode in sync when the dropdown changes without a reconnect.
+        self._api_mode = _choose_api_mode(self.api_mode_var.get(), self._base_url)
+        if self.client is not None and not self.busy:
+            self.status_var.set(f"Connected ({self._api_mode})")
+
     def start_lm_server(self) -> None:
         self.server_btn.configure(state="disabled")
         self.status_var.set("Starting LM Server...")
@@ -396,34 +472,55 @@ class AgentGui:
         self.input_box.delete("1.0", "end")
         self._append("you", user_text)
         self.memory.append("user", user_text)
+
+        # Canned greetings need no model call: answer inline, without a worker thread.
+        smalltalk = maybe_handle_smalltalk(user_text)
+        if smalltalk is not None:
+            self._append("agent", smalltalk)
+            self.memory.append("assistant", smalltalk)
+            return
+
         self.busy = True
         self.send_btn.configure(state="disabled", bg="#34496f")
         self.status_var.set("Thinking...")
         self.status_label.configure(fg=self.colors["warn"])
         self._show_typing_indicator()
+        self._stream_parts = []
+        self._streaming = False
 
         thread = threading.Thread(target=self._run_agent, args=(user_text,), daemon=True)
         thread.start()
+        self.root.after(33, self._poll_deltas)
 
     def _run_agent(self, user_text: str) -> None:
         assert self.client is not None
         model = self.model_var.get().strip() or "google/gemma-3-4b"
-        base_url = self.base_url_var.get().strip() or None
-        mode = _choose_api_mode(self.api_mode_var.get(), base_url)
+        mode = self._api_mode
 
         try:
             if mode == "chat":
-                answer = run_turn_chat(self.client, model, user_text, self.workspace, self.memory)
+                answer = run_turn_chat(self.client, model, user_text, self.workspace, self.memory, self._deltas.put)
             else:
-                answer = run_turn_responses(self.client, model, user_text, self.workspace, self.memory)
+                answer = run_turn_responses(self.client, model, user_text, self.workspace, self.memory, self._deltas.put)
         except Exception as exc:
             answer = f"Error: {exc}"
 
         self.root.after(0, self._on_agent_done, answer, mode)
 
     def _on_agent_done(self, answer: str, mode: str) -> None:
-        self._clear_typing_indicator()
-        self._append("agent", answer)
+        self._drain_deltas()
+        self._flush_chat()
+        if self._streaming:
+            self.chat.configure(state="normal")
+            self.chat.insert("end", "\n\n", "msg")
+            self.chat.configure(state="disabled")
+            self._streaming = False
+            # Errors and canned replies never went through the stream; show them separately.
+            if not "".join(self._stream_parts).strip().endswith(answer):
+                self._append("agent", answer)
+        else:
+            self._clear_typing_indicator()
+            self._append("agent", answer)
         self.memory.append("assistant", answer)
         self.busy = False
         self.send_btn.configure(state="normal", bg=self.colors["accent"])
@@ -1,38 +1,244 @@
 ﻿from __future__ import annotations
 
+import atexit
 import json
-from datetime import datetime, timezone
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+from itertools import islice
 from pathlib import Path
 from typing import Any
 
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib json module is the fallback
+    orjson = None
+
+
+CACHE_SIZE = 1024
+WRITE_BATCH = 32
+TAIL_READ_BYTES = 64 * 1024
+
+# Queued by close(): the writer finishes everything before it and exits.
+_STOP = object()
+
+
+def _loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps_line(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj) + b"\n"
+        except TypeError:
+            # orjson rejects lone surrogates (Tk on Windows hands emoji over as
+            # surrogate pairs); the stdlib encoder escapes them instead.
+            pass
+    return json.dumps(obj).encode("utf-8") + b"\n"
+
+
+def _utc_timestamp() -> str:
+    # Same format as datetime.now(timezone.utc).isoformat(), without building
+    # an aware datetime on every append.
+    seconds, micros = divmod(time.time_ns() // 1000, 1_000_000)
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))}.{micros:06d}+00:00"
+
+
+def _parse_lines(lines: list[bytes]) -> list[dict[str, Any]]:
+    items = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            items.append(_loads(line))
+        except json.JSONDecodeError:
+            # A torn last line from an interrupted write; skip it.
+            continue
+    return items
+
 
 class MemoryStore:
+    """Chat log stored as JSON Lines: one object per line, only ever appended to."""
+
     def __init__(self, path: Path) -> None:
         self.path = path
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._migrate_if_legacy_json_array()
+        self._terminate_partial_line()
+        # Newest entries, loaded on first use and then kept current by append(),
+        # so history reads never touch the disk. Appends are queued for a
+        # background writer thread, started on the first append, which writes
+        # up to WRITE_BATCH of them at a time; flush() waits for it to catch up.
+        self._cache: deque[dict[str, Any]] | None = None
+        self._lock = threading.Lock()
+        self._queue: queue.SimpleQueue[Any] = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+        self._closed = False
+        self._write_error: Exception | None = None
+        atexit.register(self.flush)
+        # Id of the last completed Responses API turn; lets the next turn chain on it.
+        self.last_response_id: str | None = None
 
-    def _read_all(self) -> list[dict[str, Any]]:
-        if not self.path.exists():
-            return []
+    def _migrate_if_legacy_json_array(self) -> None:
+        # Older versions kept the whole log as one indented JSON array.
         try:
-            return json.loads(self.path.read_text(encoding="utf-8"))
+            with self.path.open("rb") as f:
+                head = f.read(64).lstrip()
+        except FileNotFoundError:
+            return
+        if not head.startswith(b"["):
+            return
+        try:
+            items = _loads(self.path.read_bytes())
         except json.JSONDecodeError:
+            items = []
+        self._write_all([item for item in items if isinstance(item, dict)])
+
+    def _terminate_partial_line(self) -> None:
+        # After an interrupted write, start the next record on a fresh line.
+        try:
+            with self.path.open("rb+") as f:
+                if f.seek(0, os.SEEK_END) == 0:
+                    return
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+        except FileNotFoundError:
+            return
+
+    def _read_all(self) -> list[dict[str, Any]]:
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
             return []
+        return _parse_lines(data.split(b"\n"))
+
+    def _read_tail(self, count: int) -> list[dict[str, Any]]:
+        window = TAIL_READ_BYTES
+        while True:
+            try:
+                with self.path.open("rb") as f:
+                    size = f.seek(0, os.SEEK_END)
+                    start = max(0, size - window)
+                    f.seek(start)
+                    lines = f.read().split(b"\n")
+            except FileNotFoundError:
+                return []
+            if start > 0:
+                # The first line is probably cut off mid-record.
+                lines = lines[1:]
+            items = _parse_lines(lines)
+            if len(items) >= count or start == 0:
+                return items[-count:]
+            window *= 4
+
+    def _cache_locked(self) -> deque[dict[str, Any]]:
+        if self._cache is None:
+            self._cache = deque(self._read_tail(CACHE_SIZE), maxlen=CACHE_SIZE)
+        return self._cache
 
     def _write_all(self, items: list[dict[str, Any]]) -> None:
-        self.path.write_text(json.dumps(items, indent=2), encoding="utf-8")
+        fd, tmp_name = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp")
+        tmp = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"".join(_dumps_line(item) for item in items))
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(tmp, os.stat(self.path).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, self.path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def _writer_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Events are flush() markers; everything queued before one is in this batch.
+            items = [entry for entry in batch if isinstance(entry, dict)]
+            try:
+                if items:
+                    with self.path.open("ab") as f:
+                        f.write(b"".join(_dumps_line(item) for item in items))
+            except Exception as exc:
+                # Keep the thread alive; the error surfaces from the next flush().
+                self._write_error = exc
+            finally:
+                for entry in batch:
+                    if isinstance(entry, threading.Event):
+                        entry.set()
+            if _STOP in batch:
+                return
+
+    def flush(self) -> None:
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        error, self._write_error = self._write_error, None
+        if error is not None:
+            raise error
+
+    def close(self) -> None:
+        # Write out everything queued, then stop the writer thread and drop the
+        # exit hook, so a replaced store (e.g. on reconnect) is not kept alive.
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            writer = self._writer
+        atexit.unregister(self.flush)
+        if writer is not None:
+            self._queue.put(_STOP)
+            writer.join()
+        error, self._write_error = self._write_error, None
+        if error is not None:
+            raise error
 
     def append(self, role: str, content: str) -> None:
-        items = self._read_all()
-        items.append(
-            {
-                "ts": datetime.now(timezone.utc).isoformat(),
-                "role": role,
-                "content": content,
-            }
-        )
-        self._write_all(items)
+        item = {
+            "ts": _utc_timestamp(),
+            "role": role,
+            "content": content,
+        }
+        with self._lock:
+            if self._closed:
+                raise ValueError("MemoryStore is closed")
+            self._cache_locked().append(item)
+            # Queued under the lock so the file keeps the same order as the cache.
+            self._queue.put(item)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="memory-writer", daemon=True)
+                self._writer.start()
 
     def recent(self, count: int = 8) -> list[dict[str, Any]]:
-        items = self._read_all()
-        return items[-count:]
+        if count > CACHE_SIZE:
+            self.flush()
+            return self._read_tail(count)
+        return self.recent_messages(count)
+
+    def recent_messages(self, count: int) -> list[dict[str, Any]]:
+        with self._lock:
+            cache = self._cache_locked()
+            start = max(len(cache) - count, 0)
+            return list(islice(cache, start, None))
+
+    def dump_pretty(self) -> str:
+        # Debugging aid: the whole log as indented JSON; the file itself stays compact JSONL.
+        self.flush()
+        return json.dumps(self._read_all(), indent=2, ensure_ascii=False)
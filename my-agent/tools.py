@@ -1,14 +1,27 @@
 ﻿from __future__ import annotations
 
+import functools
 import json
+import os
+import re
 import subprocess
+import threading
+import time
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib json module is the fallback
+    orjson = None
 
-ALLOWED_COMMAND_PREFIXES = {
+if TYPE_CHECKING:
+    import httpx
+
+
+ALLOWED_COMMAND_PREFIXES = frozenset({
     "python",
     "py",
     "git",
@@ -18,26 +31,81 @@ ALLOWED_COMMAND_PREFIXES = {
     "type",
     "echo",
     "Get-Content",
-}
+})
+_ALLOWED_SORTED = tuple(sorted(ALLOWED_COMMAND_PREFIXES))
+
+SHELL_OUTPUT_MAX_CHARS = 8000
+# Commands made only of these characters have no pipes, redirects, quoting or
+# variables, so the builtin fast paths below can stand in for PowerShell.
+_SIMPLE_COMMAND_RE = re.compile(r"[\w .:/\\-]*")
+
+READ_FILE_MAX_CHARS = 16000
+# A UTF-8 character is at most 4 bytes, so this tail always holds the last
+# READ_FILE_MAX_CHARS characters.
+READ_FILE_TAIL_BYTES = READ_FILE_MAX_CHARS * 4
+
+# Successful web lookups keyed by normalized query, as (expires_at, result).
+# Entries expire after an hour; when full, the oldest entry is evicted first.
+_WEB_LOOKUP_CACHE: dict[str, tuple[float, dict[str, Any]]] = {}
+_WEB_LOOKUP_CACHE_SIZE = 256
+_WEB_LOOKUP_TTL_SECONDS = 3600.0
+_WEB_LOOKUP_LOCK = threading.Lock()
+_LOOKUP_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="web-lookup")
+_HTTP_CLIENT: httpx.Client | None = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+_WIKI_SEARCH = "https://en.wikipedia.org/w/api.php?action=query&list=search&srsearch=%s&utf8=&format=json&srlimit=1"
+_WIKI_SUMMARY = "https://en.wikipedia.org/api/rest_v1/page/summary/%s"
+_DDG = "https://api.duckduckgo.com/?q=%s&format=json&no_redirect=1&no_html=1"
+_quote = urllib.parse.quote
+_quote_plus = urllib.parse.quote_plus
+
+
+def _loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+
+@functools.lru_cache(maxsize=16)
+def _resolved(path_str: str) -> str:
+    return os.path.realpath(path_str)
 
 
 def _resolve_in_workspace(workspace: Path, user_path: str) -> Path:
-    candidate = (workspace / user_path).resolve() if not Path(user_path).is_absolute() else Path(user_path).resolve()
-    workspace_resolved = workspace.resolve()
-    if candidate != workspace_resolved and workspace_resolved not in candidate.parents:
+    workspace_resolved = _resolved(os.fspath(workspace))
+    # os.path.join keeps an absolute user_path as-is, like Path's / operator.
+    candidate = os.path.realpath(os.path.join(workspace_resolved, user_path))
+    ws_key = os.path.normcase(workspace_resolved)
+    candidate_key = os.path.normcase(candidate)
+    if candidate_key != ws_key and not candidate_key.startswith(ws_key.rstrip(os.sep) + os.sep):
         raise ValueError("Path is outside workspace")
-    return candidate
+    return Path(candidate)
 
 
 def run_shell(command: str, cwd: str, timeout_seconds: int = 45) -> dict[str, Any]:
-    first = command.strip().split(maxsplit=1)[0] if command.strip() else ""
+    first = command.split(None, 1)[0] if command.strip() else ""
     if first and first not in ALLOWED_COMMAND_PREFIXES:
         return {
             "ok": False,
             "error": f"Command prefix '{first}' is blocked by allowlist.",
-            "allowed_prefixes": sorted(ALLOWED_COMMAND_PREFIXES),
+            "allowed_prefixes": _ALLOWED_SORTED,
         }
 
+    builtin = _BUILTIN_COMMANDS.get(first)
+    if builtin is not None and _SIMPLE_COMMAND_RE.fullmatch(command):
+        args = command.split()[1:]
+        if not any(arg.startswith("-") for arg in args):
+            result = builtin(args, cwd)
+            if result is not None:
+                return result
+
     try:
         completed = subprocess.run(
             ["powershell", "-NoProfile", "-Command", command],
@@ -50,29 +118,115 @@ def run_shell(command: str, cwd: str, timeout_seconds: int = 45) -> dict[str, An
         return {
             "ok": completed.returncode == 0,
             "returncode": completed.returncode,
-            "stdout": completed.stdout[-8000:],
-            "stderr": completed.stderr[-8000:],
+            "stdout": completed.stdout[-SHELL_OUTPUT_MAX_CHARS:],
+            "stderr": completed.stderr[-SHELL_OUTPUT_MAX_CHARS:],
         }
     except subprocess.TimeoutExpired:
         return {"ok": False, "error": f"Command timed out after {timeout_seconds}s"}
 
 
+def _shell_output(stdout: str) -> dict[str, Any]:
+    return {"ok": True, "returncode": 0, "stdout": stdout[-SHELL_OUTPUT_MAX_CHARS:], "stderr": ""}
+
+
+def _builtin_echo(args: list[str], cwd: str) -> dict[str, Any] | None:
+    # PowerShell writes each argument of echo (Write-Output) on its own line.
+    return _shell_output("".join(arg + "\n" for arg in args))
+
+
+def _builtin_type(args: list[str], cwd: str) -> dict[str, Any] | None:
+    if len(args) != 1:
+        return None
+    result = read_file(Path(cwd), args[0])
+    if not result["ok"]:
+        return None
+    content = result["content"]
+    if content and not content.endswith("\n"):
+        content += "\n"
+    return _shell_output(content)
+
+
+def _builtin_dir(args: list[str], cwd: str) -> dict[str, Any] | None:
+    if len(args) > 1:
+        return None
+    try:
+        target = _resolve_in_workspace(Path(cwd), args[0] if args else ".")
+        with os.scandir(target) as entries:
+            names = [entry.name + os.sep if entry.is_dir() else entry.name for entry in entries]
+    except (OSError, ValueError):
+        return None
+    # Directories first, then files, each alphabetically like Get-ChildItem.
+    names.sort(key=lambda name: (not name.endswith(os.sep), name.lower()))
+    return _shell_output("".join(name + "\n" for name in names))
+
+
+# Allowlisted commands that are answered in-process instead of paying the
+# PowerShell startup; a builtin returns None to fall back to PowerShell.
+_BUILTIN_COMMANDS = {
+    "echo": _builtin_echo,
+    "type": _builtin_type,
+    "Get-Content": _builtin_type,
+    "dir": _builtin_dir,
+    "Get-ChildItem": _builtin_dir,
+}
+
+
 def read_file(workspace: Path, path: str) -> dict[str, Any]:
     try:
         resolved = _resolve_in_workspace(workspace, path)
         if not resolved.exists():
             return {"ok": False, "error": "File does not exist"}
-        return {"ok": True, "path": str(resolved), "content": resolved.read_text(encoding="utf-8")[-16000:]}
+        # Only the tail is returned, so only the tail is read and decoded.
+        with resolved.open("rb") as handle:
+            size = handle.seek(0, os.SEEK_END)
+            handle.seek(max(0, size - READ_FILE_TAIL_BYTES))
+            raw = handle.read()
+        if size > READ_FILE_TAIL_BYTES:
+            # Skip continuation bytes of a character cut off by the seek.
+            start = 0
+            while start < 3 and start < len(raw) and raw[start] & 0xC0 == 0x80:
+                start += 1
+            raw = raw[start:]
+        content = raw.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+        return {"ok": True, "path": str(resolved), "content": content[-READ_FILE_MAX_CHARS:]}
     except (OSError, UnicodeDecodeError, ValueError) as exc:
         return {"ok": False, "error": str(exc)}
 
 
+def _create_sibling_temp(target: Path) -> tuple[int, Path]:
+    # Like tempfile.mkstemp, but created with mode 0o666 so the umask applies
+    # just as for a file written directly (mkstemp always creates 0600).
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    while True:
+        tmp = target.with_name(f".{target.name}.{os.urandom(4).hex()}.tmp")
+        try:
+            return os.open(tmp, flags, 0o666), tmp
+        except FileExistsError:
+            continue
+
+
 def write_file(workspace: Path, path: str, content: str) -> dict[str, Any]:
     try:
         resolved = _resolve_in_workspace(workspace, path)
         resolved.parent.mkdir(parents=True, exist_ok=True)
-        resolved.write_text(content, encoding="utf-8")
-        return {"ok": True, "path": str(resolved), "bytes": len(content.encode("utf-8"))}
+        data = content.encode("utf-8")
+        # Write a uniquely named sibling temp file and swap it in, so an
+        # interrupted write never leaves a truncated file behind.
+        fd, tmp = _create_sibling_temp(resolved)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(tmp, os.stat(resolved).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, resolved)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return {"ok": True, "path": str(resolved), "bytes": len(data)}
     except (OSError, ValueError) as exc:
         return {"ok": False, "error": str(exc)}
 
@@ -82,12 +236,25 @@ def list_files(workspace: Path, path: str = ".") -> dict[str, Any]:
         resolved = _resolve_in_workspace(workspace, path)
         if not resolved.exists():
             return {"ok": False, "error": "Path does not exist"}
-        files = []
-        for p in resolved.rglob("*"):
-            if p.is_file():
-                files.append(str(p.relative_to(workspace)))
-            if len(files) >= 200:
-                break
+        # Depth-first scandir walk: DirEntry answers is_dir/is_file from the
+        # readdir data, and the walk stops as soon as the cap is reached.
+        ws_prefix = _resolved(os.fspath(workspace)).rstrip(os.sep) + os.sep
+        files: list[str] = []
+        stack = [os.fspath(resolved)] if resolved.is_dir() else []
+        while stack and len(files) < 200:
+            try:
+                entries = os.scandir(stack.pop())
+            except PermissionError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        entry_path = entry.path
+                        files.append(entry_path[len(ws_prefix) :] if entry_path.startswith(ws_prefix) else entry_path)
+                        if len(files) >= 200:
+                            break
         return {"ok": True, "files": files}
     except (OSError, ValueError) as exc:
         return {"ok": False, "error": str(exc)}
@@ -98,35 +265,80 @@ def web_lookup(query: str) -> dict[str, Any]:
     if not query:
         return {"ok": False, "error": "Query is empty"}
 
-    encoded = urllib.parse.quote_plus(query)
+    key = " ".join(query.lower().split())
+    cached = _WEB_LOOKUP_CACHE.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return dict(cached[1])
 
-    def _fetch_json(url: str) -> dict[str, Any]:
-        req = urllib.request.Request(
-            url,
-            headers={
-                "User-Agent": "my-agent/1.0 (+https://localhost)",
-                "Accept": "application/json",
-            },
-        )
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            return json.loads(resp.read().decode("utf-8"))
+    result = _web_lookup_uncached(query)
+    if result.get("ok"):
+        with _WEB_LOOKUP_LOCK:
+            _WEB_LOOKUP_CACHE.pop(key, None)
+            if len(_WEB_LOOKUP_CACHE) >= _WEB_LOOKUP_CACHE_SIZE:
+                _WEB_LOOKUP_CACHE.pop(next(iter(_WEB_LOOKUP_CACHE)), None)
+            _WEB_LOOKUP_CACHE[key] = (time.monotonic() + _WEB_LOOKUP_TTL_SECONDS, result)
+    return dict(result)
+
+
+def _http_client() -> httpx.Client:
+    # One pooled client for all lookups: keep-alive connections skip the
+    # TCP + TLS handshake on every request after the first to a host.
+    # The hedged lookup asks for it from two threads at once, so it is built
+    # under a lock; a second client would leak its connection pool.
+    global _HTTP_CLIENT
+    client = _HTTP_CLIENT
+    if client is not None:
+        return client
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is None:
+            # httpx already ships with openai; import it only when a lookup happens.
+            import httpx
+
+            _HTTP_CLIENT = httpx.Client(
+                headers={
+                    "User-Agent": "my-agent/1.0 (+https://localhost)",
+                    "Accept": "application/json",
+                },
+                timeout=10,
+                follow_redirects=True,
+                # With an explicit transport the client ignores limits=, so the
+                # pool limits go on the transport itself.
+                transport=httpx.HTTPTransport(
+                    retries=1,
+                    limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+                ),
+            )
+        return _HTTP_CLIENT
 
+
+def _fetch_json(url: str) -> dict[str, Any]:
+    resp = _http_client().get(url)
+    resp.raise_for_status()
+    return _loads(resp.content)
+
+
+def _web_lookup_uncached(query: str) -> dict[str, Any]:
+    encoded = _quote_plus(query)
+
+    # Hedged lookup: DuckDuckGo runs in the background while Wikipedia (the
+    # preferred source) runs here, so a Wikipedia miss costs max(), not sum().
+    ddg_future = _LOOKUP_POOL.submit(_ddg_lookup, query, encoded)
+    wiki = _wiki_lookup(encoded)
+    if wiki is not None:
+        ddg_future.cancel()
+        return wiki
+    return ddg_future.result()
+
+
+def _wiki_lookup(encoded: str) -> dict[str, Any] | None:
     # Wikipedia search API -> summary endpoint of best match.
     try:
-        search_url = (
-            "https://en.wikipedia.org/w/api.php?action=query&list=search&srsearch="
-            f"{encoded}&utf8=&format=json&srlimit=1"
-        )
-        search_data = _fetch_json(search_url)
+        search_data = _fetch_json(_WIKI_SEARCH % encoded)
         hits = (((search_data.get("query") or {}).get("search")) or [])
         if hits:
             title = (hits[0].get("title") or "").strip()
             if title:
-                summary_url = (
-                    "https://en.wikipedia.org/api/rest_v1/page/summary/"
-                    f"{urllib.parse.quote(title.replace(' ', '_'))}"
-                )
-                summary_data = _fetch_json(summary_url)
+                summary_data = _fetch_json(_WIKI_SUMMARY % _quote(title.replace(" ", "_")))
                 extract = (summary_data.get("extract") or "").strip()
                 if extract:
                     return {
@@ -138,11 +350,13 @@ def web_lookup(query: str) -> dict[str, Any]:
                     }
     except Exception:
         pass
+    return None
+
 
+def _ddg_lookup(query: str, encoded: str) -> dict[str, Any]:
     # Fallback: DuckDuckGo instant answer API.
-    ddg_url = f"https://api.duckduckgo.com/?q={encoded}&format=json&no_redirect=1&no_html=1"
     try:
-        data = _fetch_json(ddg_url)
+        data = _fetch_json(_DDG % encoded)
         abstract = (data.get("AbstractText") or "").strip()
         heading = (data.get("Heading") or "").strip()
         if abstract:
@@ -155,11 +369,17 @@ def web_lookup(query: str) -> dict[str, Any]:
             }
         related = data.get("RelatedTopics") or []
         snippets: list[str] = []
+        append = snippets.append
         for item in related:
-            if isinstance(item, dict) and isinstance(item.get("Text"), str):
-                snippets.append(item["Text"])
-            if len(snippets) >= 3:
-                break
+            # Topic groups have no "Text"; skip them and keep looking.
+            try:
+                text = item["Text"]
+            except (TypeError, KeyError):
+                continue
+            if text.__class__ is str:
+                append(text)
+                if len(snippets) == 3:
+                    break
         if snippets:
             return {
                 "ok": True,
@@ -173,7 +393,9 @@ def web_lookup(query: str) -> dict[str, Any]:
         return {"ok": False, "error": f"Web lookup failed: {exc}"}
 
 
+@functools.cache
 def get_tool_specs() -> list[dict[str, Any]]:
+    # Built once per process and shared by every caller; treat it as read-only.
     return [
         {
             "type": "function",
@@ -239,10 +461,13 @@ def get_tool_specs() -> list[dict[str, Any]]:
 
 
 def execute_tool(name: str, arguments: str, workspace: Path) -> str:
-    try:
-        args = json.loads(arguments or "{}")
-    except json.JSONDecodeError:
-        return json.dumps({"ok": False, "error": "Invalid JSON args"})
+    if not arguments or arguments == "{}":
+        args: dict[str, Any] = {}
+    else:
+        try:
+            args = _loads(arguments)
+        except json.JSONDecodeError:
+            return _dumps({"ok": False, "error": "Invalid JSON args"})
 
     if name == "run_shell":
         cwd = "."
@@ -251,7 +476,7 @@ def execute_tool(name: str, arguments: str, workspace: Path) -> str:
         try:
             resolved_cwd = _resolve_in_workspace(workspace, cwd)
         except ValueError as exc:
-            return json.dumps({"ok": False, "error": str(exc)})
+            return _dumps({"ok": False, "error": str(exc)})
         result = run_shell(args.get("command", ""), str(resolved_cwd))
     elif name == "read_file":
         result = read_file(workspace, args.get("path", ""))
@@ -264,4 +489,4 @@ def execute_tool(name: str, arguments: str, workspace: Path) -> str:
     else:
         result = {"ok": False, "error": f"Unknown tool: {name}"}
 
-    return json.dumps(result)
+    return _dumps(result)